@@ -1,328 +1,690 @@
+import ast
+import fcntl
+import hashlib
 import random
+import re
+import sys
 import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Text, Tuple, Dict
+from typing import List, Text, Tuple, Dict, Iterator
 
 import os
-from xml.etree.ElementTree import parse
 
-from sqlalchemy import create_engine
+# Aliased, models has a Coverage table
+from coverage import Coverage as CoverageMeasurement, CoverageException
+from coverage.python import PythonFileReporter
+from lxml.etree import iterparse
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
+from sqlalchemy.util import LRUCache
 
 import pygit2
 import logging
 
-from subprocess import call, DEVNULL
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain, repeat
+from subprocess import call, check_call, check_output, DEVNULL
 
 from models import *
 
 
 class DataExtractor:
     TEST_REPORT_PATH = 'test.xml'
-    COVERAGE_REPORT_PATH = 'cov.xml'
-
-    SETUP_COMMAND = 'python setup.py develop'
-    TEST_COMMAND = 'python -m pytest -q --junit-xml=' + TEST_REPORT_PATH
-    COVERAGE_COMMAND = 'python -m pytest -q {} --cov --cov-report=xml:' + COVERAGE_REPORT_PATH
+    COVERAGE_DATA_PATH = '.coverage'
+
+    # argv tuples, ready to pass without splitting a string on every call
+    SETUP_COMMAND = ('python', 'setup.py', 'develop')
+    # What the installed metadata and dependencies come from, besides the requirements*.txt files
+    SETUP_FILES = ('setup.py', 'setup.cfg', 'pyproject.toml')
+    # A new interpreter per run: it reads the .pth files setup.py develop wrote and imports none of the
+    # extractor's modules, which would shadow the project's own of the same names
+    PYTEST_COMMAND = ('python', '-m', 'pytest')
+    TEST_ARGS = ('-q', '--junit-xml=' + TEST_REPORT_PATH)
+    # One forked run records which test executed each line as a coverage context
+    COVERAGE_ARGS = ('-q', '--forked', '--cov', '--cov-context=test', '--cov-report=')
+    # Forked test processes would otherwise race on writing __pycache__
+    PYTHON_ENV = {'PYTHONDONTWRITEBYTECODE': '1'}
+
+    CLONE_DEPTH = 100
+    # Protocol v2 lets the server only advertise the refs that are asked for
+    CLONE_COMMAND = ('git', '-c', 'protocol.version=2', 'clone', '--no-tags', '--depth={}'.format(CLONE_DEPTH))
+    # Fetches the next CLONE_DEPTH commits behind the shallow boundary when the commit loop reaches it
+    DEEPEN_COMMAND = ('git', '-c', 'protocol.version=2', 'fetch', '--no-tags', '--deepen={}'.format(CLONE_DEPTH))
+    # Give up on a clone that stalls below 1 KB/s for a minute instead of blocking its worker
+    CLONE_ENV = {'GIT_HTTP_LOW_SPEED_LIMIT': '1000', 'GIT_HTTP_LOW_SPEED_TIME': '60'}
+    # Only follow first parents, the same history the commit loop walks; merged lines belong to the merge
+    BLAME_COMMAND = ('git', 'blame', '--porcelain', '--first-parent', 'HEAD', '--')
+    # Without renames a moved file is a deletion plus an addition, as in a libgit2 diff; non-ASCII paths are
+    # kept as they are instead of quoted with octal escapes
+    DIFF_COMMAND = (
+        'git', '-c', 'core.quotePath=false', 'diff',
+        '-U0', '--no-renames', '--no-color', '--no-ext-diff',
+        '--src-prefix=a/', '--dst-prefix=b/'
+    )
+    DIFF_FILE_PATTERN = re.compile(rb'^diff --git ', re.MULTILINE)
+    # '--- a/<path>' is /dev/null for an added file, '+++ b/<path>' for a deleted one; git ends a path with a
+    # space in it with a TAB
+    DIFF_PATH_PATTERN = re.compile(rb'^(?:---|\+\+\+) [ab]/(.*?)\t?$', re.MULTILINE)
+    DIFF_HUNK_PATTERN = re.compile(rb'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@', re.MULTILINE)
+    # '<hash> <orig line> <final line> <lines in hunk>' starts each hunk of the porcelain output
+    BLAME_HUNK_PATTERN = re.compile(rb'^([0-9a-f]{40}) \d+ \d+ (\d+)$', re.MULTILINE)
 
     TAG_REFNAME = "refs/tags/pptftc"
     WORKING_TAG_REFNAME = "refs/tags/pptftc_working"
     DATA_COUNT_LIMIT = 10
+    INSERT_BATCH_SIZE = 10000
+    # Under the clone root, shared by the worker processes
+    ENVIRONMENT_LOCK_PATH = '.environment.lock'
+    INSTALLED_SETUP_PATH = '.installed_setup'
 
-    def __init__(self, db_path: Path):
+    def __init__(self, session: Session):
         # Logger setup
         self.__logger = logging.getLogger('DataExtractor')
         self.__logger.setLevel(logging.DEBUG)
 
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-        ch.setFormatter(
-            logging.Formatter('[%(levelname)s] %(asctime)s: (%(name)s) %(message)s')
-        )
-        self.__logger.addHandler(ch)
-
-        # Session setup
-        engine_url = 'sqlite:///{}'.format(db_path.absolute())
-        engine = create_engine(engine_url)
+        # Worker processes inherit the handler of the parent's extractor
+        if not self.__logger.handlers:
+            ch = logging.StreamHandler()
+            ch.setLevel(logging.DEBUG)
+            ch.setFormatter(
+                logging.Formatter('[%(levelname)s] %(asctime)s: (%(name)s) %(message)s')
+            )
+            self.__logger.addHandler(ch)
 
-        self.__session = Session(engine)
+        # Share the caller's session (and its engine's pool) instead of opening the DB again
+        self.__session = session
+        # Hex commit id in git output -> interned hash, so rows share one string per commit
+        self.__hash_cache = {}
 
     def run(self):
-        cwd = Path('.').resolve()
-        clone_root = cwd / 'cloned_projects'
+        clone_root = Path('.').resolve() / 'cloned_projects'
         clone_root.mkdir(exist_ok=True)
 
         # Retrieve git project urls
-        previous_failed = True
         self.__logger.info("Reading projects list...")
-        projects = self.__session.query(Project).all()
-        self.__logger.info("Total {} projects are read".format(len(projects)))
-        for project in projects:
-            os.chdir(str(cwd))
-            project_dir = clone_root / project.id.replace('/', '_')
-            # Clone the repository
-            try:
-                self.__logger.info("Cloning {} into '{}'...".format(project.id, project_dir))
-                repo = pygit2.clone_repository(project.git_url, str(project_dir))
-                # Create an tag for current HEAD
-                repo.create_reference(DataExtractor.TAG_REFNAME, repo.head.target)
-            except ValueError:
-                self.__logger.info("'{}' exists. Skip cloning".format(project_dir))
-                repo = pygit2.Repository(str(project_dir / '.git'))
-            # Checkout the tag
-            repo.checkout(
-                repo.lookup_reference(DataExtractor.TAG_REFNAME).resolve()
+        # Plain dicts, ORM objects cannot be passed to the worker processes
+        projects = [
+            dict(id=project.id, git_url=project.git_url) for project in self.__session.query(Project)
+        ]
+        # End the read transaction, an open one would keep the workers' WAL from being checkpointed
+        self.__session.commit()
+        self.__logger.info("Total %s projects are read", len(projects))
+
+        # Projects are independent, so each one is cloned, tested and stored by its own process
+        db_path = Path(self.__session.bind.url.database)
+        with ProcessPoolExecutor() as executor:
+            for _ in executor.map(process_project, projects, repeat(db_path), repeat(clone_root)):
+                pass
+
+    def extract_project(self, project: Dict[Text, Text], clone_root: Path):
+        project_dir = clone_root / project['id'].replace('/', '_')
+        repo = self._prepare_repo(project_dir, project['git_url'])
+        self._process_repo(project['id'], repo, clone_root)
+
+    def _prepare_repo(self, project_dir: Path, git_url: Text) -> pygit2.Repository:
+        if project_dir.exists():
+            self.__logger.info("'%s' exists. Skip cloning", project_dir)
+            repo = pygit2.Repository(str(project_dir / '.git'))
+        else:
+            # Clone the repository shallowly, the commit loop deepens it when it walks past the boundary
+            self.__logger.info("Cloning %s into '%s'...", git_url, project_dir)
+            check_call(
+                DataExtractor.CLONE_COMMAND + (git_url, str(project_dir)),
+                stdout=DEVNULL, stderr=DEVNULL, env=dict(os.environ, **DataExtractor.CLONE_ENV)
             )
-            os.chdir(str(project_dir))
+            repo = pygit2.Repository(str(project_dir / '.git'))
+            # Create an tag for current HEAD
+            repo.create_reference(DataExtractor.TAG_REFNAME, repo.head.target)
+        # Checkout the tag
+        repo.checkout(
+            repo.lookup_reference(DataExtractor.TAG_REFNAME).resolve()
+        )
+        return repo
 
-            data_count = 0
-            commit_count = 0
-            # Repeat until the specified limit is reached
-            while data_count < DataExtractor.DATA_COUNT_LIMIT:
+    def _process_repo(self, project_id: Text, repo: pygit2.Repository, clone_root: Path):
+        project_dir = Path(repo.workdir)
+        previous_failed = True
+
+        data_count = 0
+        commit_count = 0
+        # Repeat until the specified limit is reached
+        while data_count < DataExtractor.DATA_COUNT_LIMIT:
+            # Rows of this commit, stored when it is done so the SQLite write lock is only held briefly
+            commit_rows = []
+            pending_rows = []
+            try:
                 # Repeat for first parent commit
                 self._checkout_commit(repo, repo.head.peel().parents[0])
                 # Only target the commits that has one parent and does not exists in the DB
                 head_commit = repo.head.peel()
-                parent_commits = head_commit.parents
+                head_hash = sys.intern(str(head_commit.id))
                 commit_count += 1
 
-                self.__logger.info("Loop for commit {} ({}) in {}".format(commit_count, head_commit.id, project.id))
+                self.__logger.info("Loop for commit %s (%s) in %s", commit_count, head_hash, project_id)
+
+                if self._is_shallow_boundary(repo, head_hash):
+                    # Parents beyond the shallow clone boundary are not fetched yet, and a libgit2 that reads
+                    # .git/shallow reports none at all; deepen the clone and walk on
+                    self.__logger.info("%s:%s is at the clone depth limit. Deepening...", project_id, head_hash)
+                    deepen_result = call(
+                        DataExtractor.DEEPEN_COMMAND,
+                        stdout=DEVNULL, stderr=DEVNULL, cwd=str(project_dir),
+                        env=dict(os.environ, **DataExtractor.CLONE_ENV)
+                    )
+                    # Opened again, the old one may keep the boundary and the parentless commit it read before
+                    repo = pygit2.Repository(repo.path)
+                    head_commit = repo.head.peel()
+                    if deepen_result != 0 or self._is_shallow_boundary(repo, head_hash):
+                        self.__logger.info("%s:%s cannot be deepened. End process", project_id, head_hash)
+                        break
+                parent_commits = head_commit.parents
+                parent_hash = sys.intern(str(parent_commits[0].id)) if len(parent_commits) != 0 else ''
 
                 if len(parent_commits) == 0:
                     # If no parent, it is initial commit. Abort
                     self.__logger.info(
-                        "{}:{} is initial commit. End process".format(project.id, head_commit.id)
+                        "%s:%s is initial commit. End process", project_id, head_hash
                     )
                     break
 
                 # If we have commit in DB already, skip it.
-                if self.__session.query(Commit).filter_by(hash=str(head_commit.id)).count() != 0:
-                    self.__logger.info("We have {}:{} in DB. Skipping...".format(project.id, head_commit.id))
+                if self.__session.query(Commit.hash).filter_by(hash=head_hash).first() is not None:
+                    self.__logger.info("We have %s:%s in DB. Skipping...", project_id, head_hash)
                     continue
 
                 # Add commit to the Commit table
-                commit_row = Commit(
-                    project_id=project.id,
-                    hash=str(head_commit.id),
-                    parent=str(parent_commits[0].id) if len(parent_commits) != 0 else '',
+                commit_rows.append(dict(
+                    project_id=project_id,
+                    hash=head_hash,
+                    parent=parent_hash,
                     timestamp=head_commit.commit_time,
                     id_num=commit_count
-                )
-                self.__session.merge(commit_row)
-                self.__session.commit()
+                ))
 
                 if len(parent_commits) != 1:
                     # If multiple parent, checkout the first parent until it has one parent
                     self.__logger.info(
-                        "{}:{} has multiple parents. Move on to first parent".format(project.id, head_commit.id)
+                        "%s:%s has multiple parents. Move on to first parent", project_id, head_hash
                     )
                     continue
 
-                parent_commit = parent_commits[0]
-                self.__logger.info("Do work for {}:{}".format(project.id, head_commit.id))
-
-                # TODO: only being tested with ambv_black project
-                # TODO: redirect stderr to logger?
-                # Run TCs
-                self.__logger.info("Running test cases for {}:{}".format(project.id, head_commit.id))
-                setup_py_file = project_dir / 'setup.py'
-                if setup_py_file.exists():
-                    self.__logger.info(" Run setup.py")
-                    setup_result = call(DataExtractor.SETUP_COMMAND.split(), stdout=DEVNULL)
-                    if setup_result != 0:
-                        self.__logger.info(" setup.py failed. End the loop")
-                        continue
-                    self.__logger.info(" Done setup.py")
-
-                self.__logger.info(" Run TCs")
-                test_report_file = project_dir / DataExtractor.TEST_REPORT_PATH
-                if test_report_file.exists():
-                    os.remove(test_report_file)
-                call(DataExtractor.TEST_COMMAND.split(), stdout=DEVNULL)
-                if not test_report_file.exists():
-                    previous_failed = False
-                    self.__logger.info(" No report. End the loop")
-                    continue
-                self.__logger.info(" Done TCs")
-
-                try:
-                    tcs = self._collect_tcs(project_dir / DataExtractor.TEST_REPORT_PATH)
-                except Exception:
-                    self.__logger.info("Something wrong with TCs. Skip the rest routines")
+                self.__logger.info("Do work for %s:%s", project_id, head_hash)
+
+                # Collect the .py hunks first, they decide whether running the TCs is worth it
+                diff_rows = [dict(
+                    project_id=project_id,
+                    commit_hash=head_hash,
+                    path=path,
+                    hunks=hunks
+                ) for path, hunks in self._diff(project_dir, parent_hash, head_hash).items()]
+                if not diff_rows and not previous_failed:
+                    # Python code is the same as in the parent, so these TCs are only useful as the
+                    # parent side of the previous commit, which did not fail
+                    self.__logger.info("%s:%s changes no .py lines. Skipping...", project_id, head_hash)
                     continue
 
-                current_failed = any(not tup[2] for tup in tcs.values())
-                if current_failed:
-                    # Add diff to the Diff table
-                    diff = repo.diff(parent_commit, head_commit, context_lines=0)
-                    hunk_tuples = []
-                    for patch in diff:
-                        diff_delta = patch.delta
-                        if diff_delta.new_file.path != diff_delta.old_file.path \
-                                or not diff_delta.new_file.path.endswith('.py'):
-                            continue
-                        for hunk in patch.hunks:
-                            hunk_tuples.append(
-                                (hunk.old_start, hunk.old_lines, hunk.new_start, hunk.new_lines)
-                            )
-                        diff_row = Diff(
-                            project_id=project.id,
-                            commit_hash=str(head_commit.id),
-                            path=diff_delta.new_file.path,
-                            hunks=hunk_tuples
+                # Every worker installs into the same environment, so only one at a time may change it or run
+                # tests on it
+                with file_lock(clone_root / DataExtractor.ENVIRONMENT_LOCK_PATH):
+                    # TODO: only being tested with ambv_black project
+                    # TODO: redirect stderr to logger?
+                    # Run TCs
+                    self.__logger.info("Running test cases for %s:%s", project_id, head_hash)
+                    has_setup_py = (project_dir / 'setup.py').exists()
+                    # Names the last install in the environment, whichever worker ran it
+                    installed_setup_file = clone_root / DataExtractor.INSTALLED_SETUP_PATH
+                    setup_digest = '{} {}'.format(project_id, self._setup_digest(project_dir))
+                    if has_setup_py and installed_setup_file.exists() and \
+                            installed_setup_file.read_text() == setup_digest:
+                        # Installed in develop mode, so only changed metadata or requirements need a new install
+                        self.__logger.info(" setup.py and requirements are unchanged. Skip setup.py")
+                    elif has_setup_py:
+                        self.__logger.info(" Run setup.py")
+                        # A failed install may leave the environment half changed
+                        remove_file(installed_setup_file)
+                        setup_result = call(
+                            DataExtractor.SETUP_COMMAND,
+                            stdout=DEVNULL,
+                            cwd=str(project_dir),
+                            env=dict(os.environ, **DataExtractor.PYTHON_ENV)
                         )
-                        self.__session.merge(diff_row)
-                    self.__session.commit()
-                else:
-                    self.__logger.info("Current TCs do not fail. Skip retrieving diff")
+                        if setup_result != 0:
+                            self.__logger.info(" setup.py failed. End the loop")
+                            continue
+                        installed_setup_file.write_text(setup_digest)
+                        self.__logger.info(" Done setup.py")
+
+                    self.__logger.info(" Run TCs")
+                    test_report_file = project_dir / DataExtractor.TEST_REPORT_PATH
+                    remove_file(test_report_file)
+                    self._run_pytest(project_dir, DataExtractor.TEST_ARGS)
+                    if not test_report_file.exists():
+                        previous_failed = False
+                        self.__logger.info(" No report. End the loop")
+                        continue
+                    self.__logger.info(" Done TCs")
 
-                if not previous_failed:
-                    self.__logger.info("Previous TCs did not fail. Skip the rest routines")
+                    try:
+                        tcs = self._collect_tcs(project_dir / DataExtractor.TEST_REPORT_PATH)
+                    except Exception:
+                        self.__logger.info("Something wrong with TCs. Skip the rest routines")
+                        continue
+
+                    current_failed = any(not tup[2] for tup in tcs.values())
+                    if current_failed:
+                        # Add diff to the Diff table
+                        pending_rows.append((Diff, diff_rows))
+                    else:
+                        self.__logger.info("Current TCs do not fail. Skip storing diff")
+
+                    if not previous_failed:
+                        self.__logger.info("Previous TCs did not fail. Skip the rest routines")
+                        previous_failed = current_failed
+                        continue
                     previous_failed = current_failed
-                    continue
-                previous_failed = current_failed
-                data_count += 1
+                    data_count += 1
 
-                self.__logger.info("{}/{} data retrieving...".format(data_count, DataExtractor.DATA_COUNT_LIMIT))
+                    self.__logger.info("%s/%s data retrieving...", data_count, DataExtractor.DATA_COUNT_LIMIT)
 
-                # Add TC to the Test table
-                for tc in tcs:
-                    test_row = Test(
-                        project_id=project.id,
-                        commit_hash=str(head_commit.id),
+                    # Add TC to the Test table
+                    pending_rows.append((Test, [dict(
+                        project_id=project_id,
+                        commit_hash=head_hash,
                         id=tc,
                         is_passed=tcs[tc][2],
                         run_time=tcs[tc][1],
                         loc=tcs[tc][0]
-                    )
-                    self.__session.merge(test_row)
-                self.__session.commit()
-
-                # Run coverage to add it to the Coverage Table
-                self.__logger.info("Running coverage for each test cases in {}:{}".format(project.id, head_commit.id))
-                every_files = set()
-                total_tcs = len(tcs)
-                tc_count = 0
-                for tc in tcs:
-                    # Run coverage
-                    coverage_report_file = project_dir / DataExtractor.COVERAGE_REPORT_PATH
-                    if coverage_report_file.exists():
-                        os.remove(coverage_report_file)
-                    call(
-                        DataExtractor.COVERAGE_COMMAND.format(tc).split(),
-                        stdout=DEVNULL
-                    )
+                    ) for tc in tcs]))
 
+                    # Run coverage to add it to the Coverage Table
+                    self.__logger.info("Running coverage for each test cases in %s:%s", project_id, head_hash)
                     try:
-                        coverages = self._collect_coverages(coverage_report_file)
+                        coverages = self._run_coverage(project_dir, tcs)
                     except Exception:
                         self.__logger.info("Something wrong with coverages. Skip the rest routines")
                         continue
 
-                    every_files.update(coverages)
-
-                    for file in coverages:
+                every_files = set()
+                coverage_rows = []
+                for tc in tcs:
+                    for file, lines_covered in coverages[tc].items():
+                        every_files.add(file)
                         # Add coverage to the Coverage table
-                        coverage_row = Coverage(
-                            project_id=project.id,
-                            commit_hash=str(head_commit.id),
+                        coverage_rows.append(dict(
+                            project_id=project_id,
+                            commit_hash=head_hash,
                             tc_id=tc,
                             file_path=file,
-                            lines_covered=coverages[file]
-                        )
-                        self.__session.merge(coverage_row)
-                    # Log progress whenever tenth digit changes
-                    tc_count += 1
-                    if int(tc_count * 100 / total_tcs) // 10 - int((tc_count-1) * 100 / total_tcs) // 10 != 0:
-                        self.__logger.info(
-                            "Progress: {}% ({}/{})...".format(int(tc_count * 100 / total_tcs), tc_count, total_tcs)
-                        )
-                self.__session.commit()
+                            lines_covered=lines_covered
+                        ))
+                pending_rows.append((Coverage, coverage_rows))
 
                 # Run git blame and add it to the File table
                 self.__logger.info(
-                    "Blame for {} files in {}:{}".format(len(every_files), project.id, head_commit.id)
+                    "Blame for %s files in %s:%s", len(every_files), project_id, head_hash
                 )
-                for file in every_files:
-                    blame = repo.blame(file)
-                    touched_hash = [None]
-                    for blame_hunk in blame:
-                        for _ in range(blame_hunk.lines_in_hunk):
-                            touched_hash.append(str(blame_hunk.final_commit_id))
-
-                    file_row = File(
-                        project_id=project.id,
-                        commit_hash=str(head_commit.id),
+                # Each blame is a git process, so threads are enough to run them side by side
+                with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                    blames = executor.map(self._blame, repeat(project_dir), every_files)
+                    file_rows = [dict(
+                        project_id=project_id,
+                        commit_hash=head_hash,
                         path=file,
-                        line_touched_hashes=touched_hash
-                    )
-                    self.__session.merge(file_row)
-                self.__session.commit()
-        os.chdir(str(cwd))
+                        line_touched_hashes=blame
+                    ) for file, blame in zip(every_files, blames)]
+                pending_rows.append((File, file_rows))
+            except BaseException:
+                # Nothing of a failed or interrupted (Ctrl-C reaches every worker) commit is stored, and the
+                # session is rolled back in case it is what failed
+                commit_rows.clear()
+                pending_rows.clear()
+                self.__session.rollback()
+                raise
+            finally:
+                if commit_rows or pending_rows:
+                    self._store_rows(commit_rows, pending_rows)
+
+    def _is_shallow_boundary(self, repo: pygit2.Repository, commit_hash: Text) -> bool:
+        # git lists the boundary commits of a shallow clone in .git/shallow, and removes it once the history is complete
+        shallow_file = Path(repo.path) / 'shallow'
+        return shallow_file.exists() and commit_hash in shallow_file.read_text().split()
+
+    def _setup_digest(self, project_dir: Path) -> Text:
+        digest = hashlib.sha1()
+        for path in sorted(chain(
+                [project_dir / name for name in DataExtractor.SETUP_FILES], project_dir.glob('requirements*.txt')
+        )):
+            if path.is_file():
+                digest.update(path.name.encode())
+                digest.update(path.read_bytes())
+        return digest.hexdigest()
+
+    def _store_rows(self, commit_rows: List[Dict], pending_rows: List[Tuple[type, List[Dict]]]):
+        upsert(self.__session, Commit, commit_rows)
+        for model, rows in pending_rows:
+            # The rows are plain column dicts, so a Core executemany skips the ORM bulk machinery
+            statement = insert_statement(model)
+            for start in range(0, len(rows), DataExtractor.INSERT_BATCH_SIZE):
+                self.__session.execute(statement, rows[start:start + DataExtractor.INSERT_BATCH_SIZE])
+        self.__session.commit()
 
     def _checkout_commit(self, repo: pygit2.Repository, commit):
         repo.create_reference(DataExtractor.WORKING_TAG_REFNAME, commit.id)
         repo.checkout(DataExtractor.WORKING_TAG_REFNAME)
         repo.lookup_reference(DataExtractor.WORKING_TAG_REFNAME).delete()
 
+    def _run_coverage(self, project_dir: Path, tcs: Dict[Text, Tuple[int, float, bool]]) -> Dict[Text, Dict[Text, List[int]]]:
+        coverage_data_file = project_dir / DataExtractor.COVERAGE_DATA_PATH
+        remove_file(coverage_data_file)
+
+        self._run_pytest(project_dir, DataExtractor.COVERAGE_ARGS)
+
+        return self._collect_coverages(coverage_data_file, tcs)
+
+    def _run_pytest(self, project_dir: Path, args: Tuple[Text, ...]) -> int:
+        return call(
+            DataExtractor.PYTEST_COMMAND + args,
+            stdout=DEVNULL,
+            cwd=str(project_dir),
+            env=dict(os.environ, **DataExtractor.PYTHON_ENV)
+        )
+
+    def _intern_hash(self, commit_id: bytes) -> Text:
+        commit_hash = self.__hash_cache.get(commit_id)
+        if commit_hash is None:
+            commit_hash = self.__hash_cache[commit_id] = sys.intern(commit_id.decode())
+        return commit_hash
+
+    def _diff(self, project_dir: Path, parent_hash: Text, head_hash: Text) -> Dict[Text, List[Tuple[int, int, int, int]]]:
+        diff = check_output(
+            DataExtractor.DIFF_COMMAND + (parent_hash, head_hash, '--', '*.py'), cwd=str(project_dir)
+        )
+
+        hunks = {}
+        for file_diff in DataExtractor.DIFF_FILE_PATTERN.split(diff)[1:]:
+            file_hunks = [
+                # A line count is left out when it is 1
+                (int(old_start), int(old_lines or 1), int(new_start), int(new_lines or 1))
+                for old_start, old_lines, new_start, new_lines in DataExtractor.DIFF_HUNK_PATTERN.findall(file_diff)
+            ]
+            path_match = DataExtractor.DIFF_PATH_PATTERN.search(file_diff)
+            if file_hunks and path_match:  # mode changes and binary files have no hunks
+                hunks[path_match.group(1).decode()] = file_hunks
+        return hunks
+
+    def _blame(self, project_dir: Path, path: Text) -> List[Tuple[Text, int]]:
+        # libgit2 cannot blame past the boundary of a shallow clone, git blames those lines on the boundary commit
+        blame = check_output(DataExtractor.BLAME_COMMAND + (path,), cwd=str(project_dir))
+
+        # Run-length encoded: one (hash, lines_in_hunk) pair per blame hunk
+        return [
+            (self._intern_hash(commit_id), int(lines_in_hunk))
+            for commit_id, lines_in_hunk in DataExtractor.BLAME_HUNK_PATTERN.findall(blame)
+        ]
+
     def _collect_tcs(self, xml_root: Path) -> Dict[Text, Tuple[int, float, bool]]:
         tcs = {}
 
-        root_node = parse(xml_root).getroot()
-        tc_nodes = root_node.findall('testcase')
-
-        for tc_node in tc_nodes:
-            class_name = tc_node.get('classname').rsplit('.')[-1]
-            file_name = tc_node.get('file')
-            tc_name = tc_node.get('name')
+        # Stream the report, dropping each testcase once it is read
+        for _, tc_node in iterparse(str(xml_root), events=('end',), tag='testcase'):
+            get = tc_node.get
+            class_name = get('classname').rsplit('.')[-1]
+            file_name = get('file')
+            tc_name = get('name')
             tc_id = '{}::{}::{}'.format(file_name, class_name, tc_name)
 
-            tc_loc = int(tc_node.get('line'))
-            tc_time = float(tc_node.get('time'))
+            tc_loc = int(get('line'))
+            tc_time = float(get('time'))
 
-            tc_failed = bool(list(tc_node.getiterator('failure')))
-            tc_error = bool(list(tc_node.getiterator('error')))  # error within TC
-            tc_skipped = bool(list(tc_node.getiterator('skipped')))
+            # The result is a direct child, so one pass over the children is enough
+            tc_status = {child.tag for child in tc_node}
+            tc_failed = 'failure' in tc_status
+            tc_error = 'error' in tc_status  # error within TC
 
             # currently, skipped tc is regarded as passed TC
             tc_passed = not (tc_failed or tc_error)
 
             tcs[tc_id] = (tc_loc, tc_time, tc_passed)
+            tc_node.clear()
+            # The cleared elements themselves stay in the tree unless they are detached
+            while tc_node.getprevious() is not None:
+                del tc_node.getparent()[0]
 
         return tcs
 
-    def _collect_coverages(self, xml_root: Path) -> Dict[Text, List[int]]:
-        coverages = {}
+    def _collect_coverages(
+            self, data_root: Path, tcs: Dict[Text, Tuple[int, float, bool]]
+    ) -> Dict[Text, Dict[Text, List[int]]]:
+        coverages = {tc: {} for tc in tcs}
+        # Consecutive lines mostly share one context list, so each distinct list is resolved once
+        resolved_contexts = {}
+
+        # Read the data file directly instead of having `coverage json` convert it first; the project's own
+        # .coveragerc decides the excluded lines as it would for a report run in the project
+        config_file = data_root.parent / '.coveragerc'
+        measurement = CoverageMeasurement(
+            data_file=str(data_root), config_file=str(config_file) if config_file.exists() else False
+        )
+        measurement.load()
+        coverage_data = measurement.get_data()
+        # Measured paths are absolute, keep them relative to the project like a report would
+        project_prefix = os.path.realpath(str(data_root.parent)) + os.sep
+        importing_tcs = self._importing_tcs(project_prefix, coverage_data.measured_files(), coverages)
+        for measured_file in coverage_data.measured_files():
+            if measured_file.startswith(project_prefix):
+                file_name = measured_file[len(project_prefix):]
+            else:
+                file_name = measured_file
+            file_importing_tcs = importing_tcs.get(measured_file, ())
+            try:
+                reporter = PythonFileReporter(measured_file, measurement)
+                statements = set(measurement.analysis2(measured_file)[1])
+            except CoverageException:
+                # Gone since the run or not Python, a report would skip it as well
+                continue
+
+            file_coverages = defaultdict(set)
+            for line, contexts in coverage_data.contexts_by_lineno(measured_file).items():
+                # Stored like `coverage xml` reports them: the first line of a multi-line statement, and no excluded
+                # lines or lines outside any statement (line 0 of an empty module)
+                line = min(reporter.translate_lines([line]), default=0)
+                if line not in statements:
+                    continue
 
-        root_node = parse(xml_root).getroot()
-        file_nodes = root_node.findall('packages/package/classes/class')
+                contexts = frozenset(contexts)
+                line_tcs = resolved_contexts.get(contexts)
+                if line_tcs is None:
+                    line_tcs = resolved_contexts[contexts] = self._context_tcs(contexts, coverages)
+                if '' in contexts:
+                    line_tcs = set(line_tcs).union(file_importing_tcs)
 
-        for file_node in file_nodes:
-            line_nodes = file_node.findall('lines/line')
-            hit_line_nodes = filter(lambda x: x.get('hits') == '1', line_nodes)
-            hit_lines = list(map(lambda x: int(x.get('number')), hit_line_nodes))
+                for tc in line_tcs:
+                    file_coverages[tc].add(line)
 
-            coverages[file_node.get('filename')] = hit_lines
+            for tc, hit_lines in file_coverages.items():
+                coverages[tc][file_name] = sorted(hit_lines)
 
         return coverages
 
+    def _context_tcs(self, contexts, tcs) -> List[Text]:
+        # Contexts are '<node id>|<setup, run or teardown>'; the empty one is left to _importing_tcs()
+        context_tcs = {context.rsplit('|', 1)[0] for context in contexts}
+        return [tc for tc in context_tcs if tc in tcs]
+
+    def _importing_tcs(self, project_prefix: Text, measured_files, tcs) -> Dict[Text, List[Text]]:
+        # Lines run outside any test (module bodies on import) go to the tests whose own file pulls the measured
+        # file in, directly or through other measured files, as a separate `pytest <tc>` run per test recorded them
+        module_files = {module_name(measured_file): measured_file for measured_file in measured_files}
+        imported_files = {}
+
+        tcs_by_file = defaultdict(list)
+        for tc in tcs:
+            tcs_by_file[tc.split('::', 1)[0]].append(tc)
+
+        importing_tcs = defaultdict(list)
+        for test_file, file_tcs in tcs_by_file.items():
+            test_path = os.path.realpath(project_prefix + test_file)
+            # pytest also imports the conftest.py files from the project root down to the test
+            pending = [test_path] + [
+                os.path.join(directory, 'conftest.py')
+                for directory in parent_dirs(os.path.dirname(test_path), project_prefix)
+            ]
+            pulled_files = set()
+            while pending:
+                path = pending.pop()
+                if path in pulled_files:
+                    continue
+                pulled_files.add(path)
+                if path not in imported_files:
+                    imported_files[path] = [
+                        module_files[module] for module in imported_modules(path) if module in module_files
+                    ]
+                pending.extend(imported_files[path])
+
+            for path in pulled_files:
+                importing_tcs[path].extend(file_tcs)
+
+        return importing_tcs
+
+
+@contextmanager
+def file_lock(path: Path):
+    # Exclusive across processes; the OS releases it as well if the holder dies
+    with path.open('a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def module_name(path: Text) -> Text:
+    # Dotted name of a module file: its path below the first directory up that is not a package
+    directory, file_name = os.path.split(path)
+    parts = [] if file_name == '__init__.py' else [os.path.splitext(file_name)[0]]
+    while os.path.isfile(os.path.join(directory, '__init__.py')):
+        directory, package = os.path.split(directory)
+        parts.insert(0, package)
+    return '.'.join(parts)
+
+
+def imported_modules(path: Text) -> Iterator[Text]:
+    # Every module an import statement of the file loads, packages included; nothing for unparsable files
+    try:
+        with open(path, 'rb') as source_file:
+            tree = ast.parse(source_file.read(), path)
+    except (OSError, SyntaxError, ValueError):
+        return
+
+    own_package = module_name(path).split('.')
+    if os.path.basename(path) != '__init__.py':
+        own_package.pop()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            # `from . import x` is relative to the package, one more level per extra dot
+            base = own_package[:len(own_package) - node.level + 1] if node.level else []
+            module = '.'.join(base + ([node.module] if node.module else []))
+            # The imported names may be submodules as well
+            names = [module] + ['{}.{}'.format(module, alias.name) for alias in node.names]
+        else:
+            continue
+        for name in names:
+            parts = name.split('.')
+            # Importing a.b.c runs a and a.b first
+            for end in range(1, len(parts) + 1):
+                yield '.'.join(parts[:end])
+
+
+def parent_dirs(directory: Text, root_prefix: Text) -> Iterator[Text]:
+    # The directory and its parents, up to the root whose path ends with a separator
+    while (directory + os.sep).startswith(root_prefix):
+        yield directory
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+
+
+def remove_file(path: Path):
+    # One unlink instead of exists() + remove(); Path.unlink(missing_ok=True) needs Python 3.8
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def process_project(project: Dict[Text, Text], db_path: Path, clone_root: Path):
+    # Runs in a worker process, which needs its own engine and session
+    DataExtractor(prepare_session(db_path)).extract_project(project, clone_root)
+
+
+@lru_cache(maxsize=None)
+def insert_statement(model, prefix: Text = None):
+    # The same statement object every time, so it is compiled once per engine
+    statement = model.__table__.insert()
+    return statement.prefix_with(prefix) if prefix else statement
+
+
+def upsert(session: Session, model, rows: List[Dict]):
+    # One executemany INSERT OR REPLACE instead of a SELECT + INSERT/UPDATE per merged row
+    if rows:
+        session.execute(insert_statement(model, 'OR REPLACE'), rows)
+
+
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    # Per connection, and every worker process has its own
+    'PRAGMA cache_size=-64000',
+)
+COMPILED_CACHE_SIZE = 1200
+
+
+def create_sqlite_engine(path: Path) -> Engine:
+    engine_url = 'sqlite:///{}'.format(path.absolute())
+    # Worker processes take turns on the write lock, wait for it rather than failing after 5 seconds
+    engine = create_engine(
+        engine_url, connect_args={'check_same_thread': False, 'timeout': 600}
+    ).execution_options(
+        # Reuse the compiled SQL of repeated Core statements, bounded since each Query builds new ones
+        compiled_cache=LRUCache(COMPILED_CACHE_SIZE)
+    )
+
+    # WAL only syncs on checkpoints: an OS crash may lose the last commits, which are re-extracted on the next run
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
 
 def prepare_session(path: Path) -> Session:
-    engine_url = 'sqlite:///{}'.format(path.absolute())
-    engine = create_engine(engine_url)
-    session = Session(engine)
+    engine = create_sqlite_engine(path)
+    # Loaded rows are only read, they need no re-SELECT after each commit
+    session = Session(engine, expire_on_commit=False)
 
     Base.metadata.create_all(engine)
 
     return session
 
 
-def load_projects(path: Path) -> List[Tuple[Text, Text]]:
-    return [
-        Project(
-            id='/'.join(line.split('/')[-2:]), git_url=line
-        ) for line in path.read_text().split() if line
-    ]
+def load_projects(path: Path) -> Iterator[Dict[Text, Text]]:
+    # Rows for the Project table, one per git url line
+    with path.open() as projects_file:
+        for line in projects_file:
+            line = line.strip()
+            if line:
+                yield dict(id='/'.join(line.split('/')[-2:]), git_url=line)
 
 
 def main():
@@ -333,18 +695,14 @@ def main():
     projects_path = Path('target_projects.txt')
 
     session = prepare_session(db_path)
-    projects = load_projects(projects_path)
-    for project in projects:
-        # insert if do not exist, update if exist.
-        session.merge(project)
+    # insert if do not exist, update if exist.
+    upsert(session, Project, list(load_projects(projects_path)))
     session.commit()
 
     # Extract the data
-    DataExtractor(db_path).run()
-
-    tests = session.query(Test).all()
+    DataExtractor(session).run()
 
-#    for instance in tests:
+#    for instance in session.query(Test).yield_per(500):
 #        print(instance.loc, instance.run_time)
 #        project = session.query(Project).filter(Project.id == instance.project_id).one()
 
@@ -1,28 +1,25 @@
+import numpy as np
+
 from models import *
 
 
 class CalculateMetric:
 
     def calculate(self, tests):
-        num_fail = 0
-        total_area = 0
-        total_fail = sum(not test.is_passed for test in tests)
-        total_run_time = sum(test.run_time for test in tests)
+        run_time = np.fromiter((test.run_time for test in tests), dtype=np.float64, count=len(tests))
+        failed = np.fromiter((test.is_passed is not True for test in tests), dtype=bool, count=len(tests))
+        total_fail = failed.sum()
+        total_run_time = run_time.sum()
 
         if total_fail == 0 or total_run_time == 0:
             return 100
 
-        for test in tests:
-            if test.is_passed is True:
-                #area = num_fail * test.run_time
-                area = (num_fail / total_fail) * (test.run_time / total_run_time) * 100
-            else:
-                #area = (((2 * num_fail) + 1) * test.run_time) / 2
-                area = (((2 * num_fail) + 1) / total_fail) * (test.run_time / total_run_time) / 2 * 100
-                num_fail += 1
-            total_area += area
-
-        return total_area
+        # Failures ordered before each test; a failing test also counts half of itself
+        num_fail = np.cumsum(failed) - failed
+        #area = num_fail * run_time, or (((2 * num_fail) + 1) * run_time) / 2 when failed
+        area = np.where(failed, num_fail + 0.5, num_fail) / total_fail * (run_time / total_run_time) * 100
+
+        return float(area.sum())
 
 
 if __name__ == '__main__':
@@ -1,10 +1,24 @@
+import json
+
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, PickleType, Boolean, \
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, \
     ForeignKey, Float
+from sqlalchemy.types import TypeDecorator
 
 Base = declarative_base()
 
 
+class JSONList(TypeDecorator):
+    # Stored as JSON text, which is also readable with plain SQL; tuples are loaded back as lists
+    impl = String  # Not Text: `from models import *` would shadow typing.Text in the importing modules
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else json.dumps(value, separators=(',', ':'))
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else json.loads(value)
+
+
 class Project(Base):
     __tablename__ = 'project'
 
@@ -16,7 +30,7 @@ class Commit(Base):
     __tablename__ = 'commit'
 
     project_id = Column(String, ForeignKey(Project.id), primary_key=True)
-    hash = Column(String)
+    hash = Column(String, index=True)  # Looked up on its own, it is not part of the primary key
     parent = Column(String)
     timestamp = Column(Integer)
     id_num = Column(Integer, primary_key=True)  # Recent commit has lower count value
@@ -28,7 +42,7 @@ class Diff(Base):
     project_id = Column(String, ForeignKey(Project.id), primary_key=True)
     commit_hash = Column(String, ForeignKey(Commit.hash), primary_key=True)
     path = Column(String, primary_key=True)
-    hunks = Column(PickleType)  # List[(old_start, old_lines, new_start, new_lines)]
+    hunks = Column(JSONList)  # List[(old_start, old_lines, new_start, new_lines)]
 
 
 class File(Base):
@@ -37,7 +51,7 @@ class File(Base):
     project_id = Column(String, ForeignKey(Project.id), primary_key=True)
     commit_hash = Column(String, ForeignKey(Commit.hash), primary_key=True)
     path = Column(String, primary_key=True)
-    line_touched_hashes = Column(PickleType)
+    line_touched_hashes = Column(JSONList)  # List[(commit_hash, lines_in_hunk)]
 
 
 class Test(Base):
@@ -60,4 +74,4 @@ class Coverage(Base):
     tc_id = Column(String, ForeignKey(Test.id), primary_key=True)
     file_path = Column(String, ForeignKey(File.path), primary_key=True)
 
-    lines_covered = Column(PickleType)
+    lines_covered = Column(JSONList)
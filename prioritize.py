@@ -1,11 +1,10 @@
-import bisect
-import random
 from collections import Counter
 from enum import Enum, auto
 from functools import partial
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict
 
+import numpy as np
 import pandas as pd
 from sqlalchemy.orm import Session
 
@@ -13,6 +12,14 @@ import data_extract
 from metric import CalculateMetric
 from models import *
 
+try:
+    # Cython is optional, the numpy version below is used without it
+    import pyximport
+    pyximport.install(language_level=3)
+    import prioritize_kernel
+except ImportError:
+    prioritize_kernel = None
+
 
 class PrioritizeMethod(Enum):
     BaseRandom = auto()
@@ -29,36 +36,54 @@ class PrioritizeMethod(Enum):
 
 
 class Prioritizer:
-    METHOD_MAPPING = None
+    YIELD_PER_ROWS = 10000
+
+    # Columns of the per-test metric rows
+    ROW_LOC, ROW_NEG_LOC, ROW_COVERED_LOC, ROW_NEG_COVERED_LOC, ROW_RUN_TIME, ROW_NEG_RUN_TIME, \
+        ROW_NEG_LATEST_COUNT, ROW_NEG_LATEST_RATIO, ROW_AHEAD_SUM, ROW_AHEAD_AVERAGE = range(10)
 
-    def __init__(self, session: Session):
+    def __init__(self, session: Session, random_seed: int = None):
         self._session = session
+        # Seed for by_random(), so experiments can repeat the random order
+        self._random = np.random.RandomState(random_seed)
+        # Commits and their interned ids per project id, kept until clear_project_cache()
+        self._project_cache = {}
 
         self._target_project = None
         self._target_commit = None
+        self._target_hash_id = None
 
         self._data_commits = None
+        self._hashes = None
+        self._hash_ids = None
+        self._commit_id_nums = None
         self._data_files = None
+        self._file_hash_ids = None
         self._data_tests = None
         self._data_coverages = None
+        self._covered_lines = None
         self._data_diffs = None
 
         self._covering_hashes = None
-
-        if Prioritizer.METHOD_MAPPING is None:
-            Prioritizer.METHOD_MAPPING = {
-                PrioritizeMethod.BaseRandom: self.by_random,
-                PrioritizeMethod.BaseLOCInc: partial(self.by_loc, desc=False),
-                PrioritizeMethod.BaseLOCDesc: partial(self.by_loc, desc=True),
-                PrioritizeMethod.BaseCoverageInc: partial(self.by_coverage, desc=False),
-                PrioritizeMethod.BaseCoverageDesc: partial(self.by_coverage, desc=True),
-                PrioritizeMethod.BaseRuntimeInc: partial(self.by_run_time, desc=False),
-                PrioritizeMethod.BaseRuntimeDesc: partial(self.by_run_time, desc=True),
-                PrioritizeMethod.LatestCommitRatio: self.by_latest_commit_count,
-                PrioritizeMethod.LatestCommitCount: self.by_latest_commit_ratio,
-                PrioritizeMethod.CommitAheadAverage: self.by_commit_ahead_average,
-                PrioritizeMethod.CommitAheadSum: self.by_commit_ahead_sum,
-            }
+        self._covered_loc = None
+        self._latest_commit_count = None
+        self._metric_tests = None
+        self._metric_rows = None
+
+        # Bound to this instance; a class-level mapping would keep calling the first instance's methods
+        self._method_mapping = {
+            PrioritizeMethod.BaseRandom: self.by_random,
+            PrioritizeMethod.BaseLOCInc: partial(self.by_loc, desc=False),
+            PrioritizeMethod.BaseLOCDesc: partial(self.by_loc, desc=True),
+            PrioritizeMethod.BaseCoverageInc: partial(self.by_coverage, desc=False),
+            PrioritizeMethod.BaseCoverageDesc: partial(self.by_coverage, desc=True),
+            PrioritizeMethod.BaseRuntimeInc: partial(self.by_run_time, desc=False),
+            PrioritizeMethod.BaseRuntimeDesc: partial(self.by_run_time, desc=True),
+            PrioritizeMethod.LatestCommitRatio: self.by_latest_commit_count,
+            PrioritizeMethod.LatestCommitCount: self.by_latest_commit_ratio,
+            PrioritizeMethod.CommitAheadAverage: self.by_commit_ahead_average,
+            PrioritizeMethod.CommitAheadSum: self.by_commit_ahead_sum,
+        }
 
     @property
     def target_project(self):
@@ -68,14 +93,34 @@ class Prioritizer:
     def target_project(self, value: Project):
         self._target_project = value
 
-        commits = self._session.query(Commit).filter_by(project_id=value.id).all()
-        self._data_commits = {commit.hash: commit for commit in commits}
+        if value.id not in self._project_cache:
+            commits = self._session.query(Commit).filter_by(project_id=value.id).all()
+            data_commits = {commit.hash: commit for commit in commits}
+            # Commit hashes as small ints for the numpy kernels; blamed commits outside the DB get theirs on demand
+            hashes = list(data_commits)
+            hash_ids = {commit_hash: hash_id for hash_id, commit_hash in enumerate(hashes)}
+            commit_id_nums = np.array([commit.id_num for commit in data_commits.values()], dtype=np.int64)
+            self._project_cache[value.id] = (data_commits, hashes, hash_ids, commit_id_nums)
 
+        # Ids interned later are appended, so the cached ids stay valid across switches
+        self._data_commits, self._hashes, self._hash_ids, self._commit_id_nums = self._project_cache[value.id]
+
+        self._target_hash_id = None
         self._data_files = None
+        self._file_hash_ids = None
         self._data_tests = None
         self._data_coverages = None
+        self._covered_lines = None
         self._data_diffs = None
         self._covering_hashes = None
+        self._covered_loc = None
+        self._latest_commit_count = None
+        self._metric_tests = None
+        self._metric_rows = None
+
+    def clear_project_cache(self):
+        # For a DB that got new commits; the next target_project assignment reloads them
+        self._project_cache.clear()
 
     @property
     def target_commit(self):
@@ -88,8 +133,10 @@ class Prioritizer:
         files = self._session.query(File).filter_by(
             project_id=self._target_project.id,
             commit_hash=self._target_commit.parent
-        )
+        ).yield_per(Prioritizer.YIELD_PER_ROWS)
         self._data_files = {file.path: file for file in files}
+        # Blame of each file as interned commit ids, shared by all tests
+        self._file_hash_ids = {path: self._get_line_hash_ids(file) for path, file in self._data_files.items()}
 
         tests = self._session.query(Test).filter_by(
             project_id=self._target_project.id,
@@ -105,84 +152,95 @@ class Prioritizer:
 
         self._data_diffs = {diff.path: diff for diff in diffs}
 
-        self._data_coverages = {}
-
-        for test_id in self._data_tests.keys():
-            coverages = self._session.query(Coverage).filter_by(
-                project_id=self._target_project.id,
-                commit_hash=self._target_commit.parent,
-                tc_id=test_id
-            ).all()
-
-            self._data_coverages[test_id] = {
-                coverage.file_path: coverage
-                for coverage in coverages
-            }
-
+        # One query for the whole commit, grouped by test here; streamed since it is the largest table
+        coverages = self._session.query(Coverage).filter_by(
+            project_id=self._target_project.id,
+            commit_hash=self._target_commit.parent
+        ).yield_per(Prioritizer.YIELD_PER_ROWS)
+
+        self._data_coverages = {test_id: {} for test_id in self._data_tests.keys()}
+        # Covered lines as arrays, converted once per (test, file); data_extract stores them sorted
+        self._covered_lines = {test_id: {} for test_id in self._data_tests.keys()}
+        for coverage in coverages:
+            test_coverages = self._data_coverages.get(coverage.tc_id)
+            if test_coverages is not None:
+                test_coverages[coverage.file_path] = coverage
+                self._covered_lines[coverage.tc_id][coverage.file_path] = np.array(
+                    coverage.lines_covered, dtype=np.int32
+                )
+
+        self._target_hash_id = self._intern_hash(self._target_commit.hash)
         self._covering_hashes = {
             test_id: self._get_covering_hashes(test_id)
             for test_id in self._data_tests.keys()
         }
 
+        # Sort keys read these for every comparison, so they are computed once per commit
+        self._covered_loc = {
+            test_id: sum(covered_lines.size for covered_lines in test_covered_lines.values()) or 1
+            for test_id, test_covered_lines in self._covered_lines.items()
+        }
+        self._latest_commit_count = {
+            test_id: int(counts[self._target_hash_id])
+            for test_id, counts in self._covering_hashes.items()
+        }
+
+        # Every sort key of every method, computed in one pass over the tests
+        self._metric_tests = list(self._data_tests.values())
+        metric_rows = []
+        for test in self._metric_tests:
+            covered_loc = self._get_covered_loc(test)
+            latest_commit_count = self._get_latest_commit_count(test)
+            ahead_count = self._get_ahead_count(test)
+            metric_rows.append((
+                test.loc, -test.loc,
+                covered_loc, -covered_loc,
+                test.run_time, -test.run_time,
+                -latest_commit_count, -(latest_commit_count / covered_loc),
+                ahead_count, ahead_count / covered_loc
+            ))
+        self._metric_rows = np.array(metric_rows, dtype=np.float64).reshape(len(metric_rows), 10)
+
     @property
     def has_failed_test(self):
         return any(not test.is_passed for test in self._data_tests.values())
 
     def by_random(self) -> List[Test]:
-        tests = list(self._data_tests.values())
-        random.shuffle(tests)
-
-        return tests
+        # A fresh order of the test list the setter already built
+        return [self._metric_tests[index] for index in self._random.permutation(len(self._metric_tests))]
 
     def by_loc(self, desc=False) -> List[Test]:
-        multiplier = -1 if desc else 1
-        return sorted(
-            self._data_tests.values(),
-            key=lambda x: (x.loc * multiplier, x.run_time)
-        )
+        return self._sorted_tests(Prioritizer.ROW_NEG_LOC if desc else Prioritizer.ROW_LOC, Prioritizer.ROW_RUN_TIME)
 
     def by_coverage(self, desc=False) -> List[Test]:
-        multiplier = -1 if desc else 1
-        return sorted(
-            self._data_tests.values(),
-            key=lambda x: (self._get_covered_loc(x) * multiplier, x.run_time)
+        return self._sorted_tests(
+            Prioritizer.ROW_NEG_COVERED_LOC if desc else Prioritizer.ROW_COVERED_LOC, Prioritizer.ROW_RUN_TIME
         )
 
     def by_run_time(self, desc=False) -> List[Test]:
-        multiplier = -1 if desc else 1
-        return sorted(
-            self._data_tests.values(),
-            key=lambda x: x.run_time * multiplier
-        )
+        return self._sorted_tests(Prioritizer.ROW_NEG_RUN_TIME if desc else Prioritizer.ROW_RUN_TIME)
 
     def by_latest_commit_count(self) -> List[Test]:
-        return sorted(
-            self._data_tests.values(),
-            key=lambda x: (-self._get_latest_commit_count(x), x.run_time)
-        )
+        return self._sorted_tests(Prioritizer.ROW_NEG_LATEST_COUNT, Prioritizer.ROW_RUN_TIME)
 
     def by_latest_commit_ratio(self) -> List[Test]:
-        return sorted(
-            self._data_tests.values(),
-            key=lambda x: -(self._get_latest_commit_count(x) / self._get_covered_loc(x))
-        )
+        return self._sorted_tests(Prioritizer.ROW_NEG_LATEST_RATIO)
 
     def by_commit_ahead_sum(self) -> List[Test]:
-        return sorted(
-            self._data_tests.values(),
-            key=lambda x: (self._get_ahead_count(x), x.run_time)
-        )
+        return self._sorted_tests(Prioritizer.ROW_AHEAD_SUM, Prioritizer.ROW_RUN_TIME)
 
     def by_commit_ahead_average(self) -> List[Test]:
-        return sorted(
-            self._data_tests.values(),
-            key=lambda x: self._get_ahead_count(x) / self._get_covered_loc(x),
-        )
+        return self._sorted_tests(Prioritizer.ROW_AHEAD_AVERAGE)
+
+    def _sorted_tests(self, *columns: int) -> List[Test]:
+        # lexsort is stable and takes its primary key last, so ties keep the test order like sorted() did
+        order = np.lexsort([self._metric_rows[:, column] for column in reversed(columns)])
+        return [self._metric_tests[index] for index in order]
 
     def by_all(self) -> Dict[PrioritizeMethod, List[Test]]:
         return {
             method: func()
-            for method, func in Prioritizer.METHOD_MAPPING.items()
+            for method, func in self._method_mapping.items()
         }
 
     def get_raw_values(self) -> Dict[PrioritizeMethod, List[Test]]:
@@ -197,93 +255,114 @@ class Prioritizer:
         }
 
         for test in self._data_tests.values():
-            results[PrioritizeMethod.BaseLOCDesc].append(
-                test.loc
-            )
-            results[PrioritizeMethod.BaseCoverageInc].append(
-                self._get_covered_loc(test)
-            )
-            results[PrioritizeMethod.BaseRuntimeInc].append(
-                test.run_time
-            )
-            results[PrioritizeMethod.LatestCommitCount].append(
-                self._get_latest_commit_count(test)
-            )
-            results[PrioritizeMethod.LatestCommitRatio].append(
-                self._get_latest_commit_count(test) / self._get_covered_loc(test)
-            )
-            results[PrioritizeMethod.CommitAheadSum].append(
-                self._get_ahead_count(test)
-            )
-            results[PrioritizeMethod.CommitAheadAverage].append(
-                self._get_ahead_count(test) / self._get_covered_loc(test)
-            )
+            # Each quantity once per test, the ratios share them
+            covered_loc = self._get_covered_loc(test)
+            latest_commit_count = self._get_latest_commit_count(test)
+            ahead_count = self._get_ahead_count(test)
+
+            results[PrioritizeMethod.BaseLOCDesc].append(test.loc)
+            results[PrioritizeMethod.BaseCoverageInc].append(covered_loc)
+            results[PrioritizeMethod.BaseRuntimeInc].append(test.run_time)
+            results[PrioritizeMethod.LatestCommitCount].append(latest_commit_count)
+            results[PrioritizeMethod.LatestCommitRatio].append(latest_commit_count / covered_loc)
+            results[PrioritizeMethod.CommitAheadSum].append(ahead_count)
+            results[PrioritizeMethod.CommitAheadAverage].append(ahead_count / covered_loc)
 
         return results
 
-    def _get_covering_hashes(self, test_path: str) -> Counter:
-        covering_hashes = Counter()
-        for file_name, file in self._data_files.items():
+    def covering_counter(self, test: Test) -> Counter:
+        # Covered lines per blamed commit hash of the test, built from the counts only when asked for
+        counts = self._covering_hashes[test.id]
+        return Counter({self._hashes[hash_id]: int(counts[hash_id]) for hash_id in np.flatnonzero(counts)})
+
+    def _get_covering_hashes(self, test_path: str) -> np.ndarray:
+        target_hash_id = self._target_hash_id
+        # Every hash of the commit is interned by now, so one slot per id
+        counts = np.zeros(len(self._hashes), dtype=np.int64)
+        for file_name in self._data_files.keys():
             diff_hunks = self._data_diffs[file_name].hunks if file_name in self._data_diffs else []
 
-            if file_name not in self._data_coverages[test_path]:
+            if file_name not in self._covered_lines[test_path]:
                 continue
 
-            coverage = self._data_coverages[test_path][file_name]
-            covered_line = coverage.lines_covered
-            file_hashes = file.line_touched_hashes[:]
-            file_length = len(file.line_touched_hashes)
-
-            for hunk in diff_hunks:
-                old_start, old_lines, new_start, new_lines = hunk
+            covered_line = self._covered_lines[test_path][file_name]
+            line_hash_ids = self._file_hash_ids[file_name]
+            file_length = len(line_hash_ids)
+
+            # Only added hunks change the result, covered lines keep their blamed commit otherwise
+            added_hunks = [
+                hunk for hunk in diff_hunks
+                if hunk[1] == 0 and hunk[3] > 0
+            ]
+            # The kernel indexes without bounds checks; lines past the blame (a working tree that differs from
+            # HEAD) are left to the numpy version, which raises IndexError for them
+            in_blame = covered_line.size == 0 or (covered_line[0] >= 1 and covered_line[-1] <= file_length)
+            if prioritize_kernel is not None and in_blame:
+                prioritize_kernel.cover_kernel(
+                    line_hash_ids, covered_line,
+                    np.array([hunk[2:] for hunk in added_hunks], dtype=np.int64).reshape(len(added_hunks), 2),
+                    target_hash_id, counts
+                )
+                continue
 
-                if old_lines == 0 and new_lines > 0:  # added
-                    prev_covered = self._has_value(covered_line, new_start - 1) if new_start > 1 else True
-                    next_covered = self._has_value(covered_line, new_start) if new_start <= file_length else True
+            if added_hunks:
+                # Look up the lines around every added hunk in one search
+                new_starts = np.array([hunk[2] for hunk in added_hunks])
+                prev_covered = (new_starts <= 1) | self._has_values(covered_line, new_starts - 1)
+                next_covered = (new_starts > file_length) | self._has_values(covered_line, new_starts)
 
-                    if prev_covered and next_covered:
-                        covering_hashes.update([self._target_commit.hash] * new_lines)
-                else:  # deleted or modified
-                    file_hashes[old_start:old_lines] = self._target_commit.hash
+                for hunk, is_covered in zip(added_hunks, prev_covered & next_covered):
+                    if is_covered:
+                        counts[target_hash_id] += hunk[3]
 
-            file_hashes = [file.line_touched_hashes[line - 1] for line in covered_line]
-            covering_hashes.update(file_hashes)
+            counts += count_blamed_hash_ids(line_hash_ids, covered_line, len(counts))
 
-        return covering_hashes
+        return counts
 
     def _get_latest_commit_count(self, test: Test) -> int:
-        return self._covering_hashes[test.id][self._target_commit.hash]
+        return self._latest_commit_count[test.id]
 
     def _get_ahead_count(self, test: Test) -> int:
-        counter = self._covering_hashes[test.id]
+        # The commits in the DB hold the first ids, blamed commits outside it are left out
+        counts = self._covering_hashes[test.id][:len(self._commit_id_nums)]
+        is_covering = counts > 0
+        if not is_covering.any():
+            return 0
 
-        commit_count_list = [
-            self._data_commits[hash].id_num
-            for hash in counter
-            if hash in self._data_commits
-        ]
+        commit_id_nums = self._commit_id_nums[is_covering]
+        return int(((commit_id_nums - commit_id_nums.min()) * counts[is_covering]).sum())
 
-        min_commit_count = min(commit_count_list) if commit_count_list else 0
+    def _get_covered_loc(self, test: Test) -> int:
+        return self._covered_loc[test.id]
 
-        return sum(
-            (self._data_commits[hash].id_num - min_commit_count) * id_num
-            for hash, id_num in counter.items()
-            if hash in self._data_commits
-        )
+    def _get_line_hash_ids(self, file: File) -> np.ndarray:
+        # Expanded from the run-length encoded blame, one id per hunk, behind the placeholder at index 0 that
+        # the flat per-line blame list started with
+        hunk_hash_ids = [self._intern_hash(None)]
+        lines_in_hunks = [1]
+        for commit_hash, lines_in_hunk in file.line_touched_hashes:
+            hunk_hash_ids.append(self._intern_hash(commit_hash))
+            lines_in_hunks.append(lines_in_hunk)
 
-    def _get_covered_loc(self, test: Test) -> int:
-        result = sum(len(coverage.lines_covered) for coverage in self._data_coverages[test.id].values())
+        return np.repeat(np.array(hunk_hash_ids, dtype=np.int64), lines_in_hunks)
 
-        return result if result else 1
+    def _intern_hash(self, commit_hash) -> int:
+        hash_id = self._hash_ids.get(commit_hash)
+        if hash_id is None:
+            hash_id = self._hash_ids[commit_hash] = len(self._hashes)
+            self._hashes.append(commit_hash)
+        return hash_id
 
-    def _get_commit_time_diff(self, commit: Commit) -> int:
-        latest_commit = self._data_commits[self._target_commit.hash]
+    def _has_values(self, array: np.ndarray, values: np.ndarray) -> np.ndarray:
+        if array.size == 0:
+            return np.zeros(len(values), dtype=bool)
+        indices = np.searchsorted(array, values)
+        return (indices < array.size) & (array[np.minimum(indices, array.size - 1)] == values)
 
-        return latest_commit.timestamp - commit.timestamp
 
-    def _has_value(self, list: List, value: Any):
-        index = bisect.bisect_left(list, value)
-        return list[index] == value if index < len(list) else False
+def count_blamed_hash_ids(line_hash_ids: np.ndarray, covered_lines: np.ndarray, hash_count: int) -> np.ndarray:
+    # How many covered lines each commit touched last, indexed by hash id; line n is read at index n - 1
+    return np.bincount(line_hash_ids[covered_lines - 1], minlength=hash_count)
 
 
 def main():
@@ -298,7 +377,7 @@ def main():
         for method in PrioritizeMethod.__members__.values()
     }
 
-    corr = None
+    corr_frames = []
 
     for project in projects:
         commits = session.query(Commit).filter_by(
@@ -314,11 +393,7 @@ def main():
                 continue
 
             commit_results = pri.by_all()
-            commit_corr = pd.DataFrame(pri.get_raw_values())
-            if corr is not None:
-                corr = pd.concat([corr, commit_corr])
-            else:
-                corr = commit_corr
+            corr_frames.append(pd.DataFrame(pri.get_raw_values()))
 
             for method, tests in commit_results.items():
                 results[method].append(calc.calculate(tests))
@@ -328,6 +403,8 @@ def main():
         #print(method, sum(metrics) / len(metrics))
         print(method, round(sum(metrics) / len(metrics), 2))
 
+    # Concatenated once, growing the frame per commit copies it every time
+    corr = pd.concat(corr_frames, ignore_index=True)
     print(round(corr.corr(), 2))
 
 
@@ -0,0 +1,31 @@
+# cython: boundscheck=False, wraparound=False
+# Optional compiled version of the per-file loop of Prioritizer._get_covering_hashes, built on import by pyximport
+from libc.stdint cimport int32_t, int64_t
+
+
+cdef bint has_value(const int32_t[::1] array, int64_t value) nogil:
+    # Binary search over the sorted covered lines
+    cdef Py_ssize_t low = 0, high = array.shape[0], middle
+    while low < high:
+        middle = (low + high) // 2
+        if array[middle] < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low < array.shape[0] and array[low] == value
+
+
+def cover_kernel(const int64_t[::1] line_hash_ids, const int32_t[::1] covered_sorted, const int64_t[:, ::1] added_hunks,
+                 Py_ssize_t target_id, int64_t[::1] out_counts):
+    # added_hunks holds (new_start, new_lines) of the added hunks of the file
+    cdef Py_ssize_t file_length = line_hash_ids.shape[0], index
+    cdef int64_t new_start
+    with nogil:
+        for index in range(added_hunks.shape[0]):
+            new_start = added_hunks[index, 0]
+            if (new_start <= 1 or has_value(covered_sorted, new_start - 1)) and \
+                    (new_start > file_length or has_value(covered_sorted, new_start)):
+                out_counts[target_id] += added_hunks[index, 1]
+
+        for index in range(covered_sorted.shape[0]):
+            out_counts[line_hash_ids[covered_sorted[index] - 1]] += 1